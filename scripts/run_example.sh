@@ -82,6 +82,10 @@ init_terraform() {
         return 1
     fi
     
+    # Reuse downloaded providers across runs instead of fetching them again
+    export TF_PLUGIN_CACHE_DIR="${TF_PLUGIN_CACHE_DIR:-$HOME/.terraform.d/plugin-cache}"
+    mkdir -p "$TF_PLUGIN_CACHE_DIR"
+    
     terraform init
     print_success "Terraform initialized"
     cd ..
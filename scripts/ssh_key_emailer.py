@@ -0,0 +1,1065 @@
+"""
+SSH Key Emailer for AWS EC2 User Provisioning
+
+This module sends SSH private keys to users via email after they have been
+provisioned on EC2 instances. It reads user information and generated keys
+from the keys directory and sends personalized emails to each user.
+
+It is importable on its own so long-running callers can reuse one
+SSHKeyEmailer (and its caches) across batches; send_keys.py is the CLI.
+
+Performance notes:
+The workload is I/O-bound: SMTP round-trips dominate, followed by reading
+small key files and parsing users.yaml. Speedups come from reusing and
+parallelizing SMTP sessions, reading files concurrently and caching parsed
+input. SIMD or similar CPU-level tuning of MIME encoding will not pay off.
+
+Requirements:
+- Python 3.6+
+- smtplib (built-in)
+- yaml (PyYAML package)
+- json (built-in)
+- os (built-in)
+- sys (built-in)
+"""
+
+import smtplib
+import ssl
+import yaml
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import email.policy
+from email.message import EmailMessage
+from datetime import datetime, timezone
+from string import Template
+import copy
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+# Prefer the LibYAML-backed loader; fall back to pure Python if it isn't built
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+# Format of the "Generated" timestamp shown in emails
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S UTC'
+
+# Stands in for the generation timestamp in rendered dry runs, so two runs diff cleanly
+DRY_RUN_TIMESTAMP = '<generated at send time>'
+
+# Envelope sender, From header and subject prefix shared by every message
+FROM_ADDRESS = 'noreply@mailhost.umb.com'
+FROM_HEADER = f'EC2-Provisioning <{FROM_ADDRESS}>'
+SUBJECT_PREFIX = 'SSH Key for EC2 Access - '
+
+# Per-user fields the emailer reads; other fields in users.yaml are never constructed
+USER_FIELDS = frozenset(('username', 'full_name', 'email'))
+
+# Suffix of the JSON sidecar caching the parsed users file
+USERS_CACHE_SUFFIX = '.cache.json'
+
+# Format version of the sidecar; bump whenever the shape of a parsed user changes
+USERS_CACHE_VERSION = 3
+
+# In-process LRU cache of parsed users files: path -> (mtime_ns, size, users)
+USERS_CACHE_SIZE = 100
+_USERS_CACHE = OrderedDict()
+
+# Lines starting with a dot, which must be doubled inside SMTP DATA
+DOT_STUFF_RE = re.compile(br'(?m)^\.')
+
+# Minimum sends attempted before a high failure rate aborts the batch
+ABORT_MIN_ATTEMPTS = 30
+
+# Suffix of private key files in the keys directory
+KEY_FILE_SUFFIX = '_private_key'
+KEY_FILE_SUFFIX_LEN = len(KEY_FILE_SUFFIX)
+
+# Placeholder instance details used when no instance info is supplied
+DEFAULT_INSTANCE_INFO = {
+    'instance_id': 'EC2 Instance',
+    'ip_address': 'EC2_IP_ADDRESS',
+    'instance_type': 'EC2 Instance',
+    'region': 'AWS Region'
+}
+
+# Stylesheet for the HTML body, minified once at import since every message carries it
+EMAIL_CSS = """
+body { font-family: Arial, sans-serif; margin: 20px; }
+.header { background-color: #f8f9fa; padding: 20px; border-radius: 5px; }
+.content { margin: 20px 0; }
+.instance-info { background-color: #e3f2fd; padding: 15px; border-radius: 5px; margin: 20px 0; }
+.warning { background-color: #fff3cd; border: 1px solid #ffeaa7; padding: 15px; border-radius: 5px; margin: 20px 0; }
+.footer { margin-top: 30px; padding-top: 20px; border-top: 1px solid #dee2e6; color: #6c757d; }
+code { background-color: #f8f9fa; padding: 2px 4px; border-radius: 3px; font-family: monospace; }
+"""
+EMAIL_CSS = re.sub(r'\s*([{}:;,])\s*', r'\1', re.sub(r'\s+', ' ', EMAIL_CSS)).strip().replace(';}', '}')
+
+# Email body templates, compiled once and filled in per user
+HTML_TEMPLATE = Template("""
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>SSH Key for EC2 Access - $username</title>
+    <style>""" + EMAIL_CSS + """</style>
+</head>
+<body>
+    <div class="header">
+        <h2>🔑 SSH Key for EC2 Access - $username</h2>
+        <p><strong>Full Name:</strong> $full_name</p>
+        <p><strong>Generated:</strong> $generated</p>
+    </div>
+    
+    <div class="instance-info">
+        <h3>🏗️ Instance Information</h3>
+        <p><strong>Instance ID:</strong> $instance_id</p>
+        <p><strong>IP Address:</strong> $ip_address</p>
+        <p><strong>Instance Type:</strong> $instance_type</p>
+        <p><strong>Region:</strong> $region</p>
+    </div>
+    
+    <div class="content">
+        <h3>Your SSH Private Key</h3>
+        <p>Your SSH private key has been generated and is attached to this email. Use this key to access your EC2 instance.</p>
+        
+        <div class="warning">
+            <h4>⚠️ Security Important</h4>
+            <ul>
+                <li>Keep this private key secure and never share it</li>
+                <li>Store it in ~/.ssh/ directory</li>
+                <li>Set proper permissions: chmod 600 your_key_file</li>
+                <li>Never commit private keys to version control</li>
+                <li>This key is unique to your user account</li>
+            </ul>
+        </div>
+        
+        <h3>📋 How to Use</h3>
+        <ol>
+            <li>Save the attached file ${username}_private_key to ~/.ssh/${username}_key</li>
+            <li>Set proper permissions: <code>chmod 600 ~/.ssh/${username}_key</code></li>
+            <li>Connect to EC2: <code>ssh -i ~/.ssh/${username}_key $username@$ip_address</code></li>
+        </ol>
+    </div>
+    
+    <div class="footer">
+        <p>This is an automated message from the AWS EC2 User Provisioning System.</p>
+        <p>If you have any questions, please contact your system administrator.</p>
+    </div>
+</body>
+</html>
+""")
+
+TEXT_TEMPLATE = Template("""SSH Key for EC2 Access - $username
+==========================================
+
+User Information:
+- Username: $username
+- Full Name: $full_name
+- Generated: $generated
+
+Instance Information:
+- Instance ID: $instance_id
+- IP Address: $ip_address
+- Instance Type: $instance_type
+- Region: $region
+
+Your SSH private key has been generated and is attached to this email
+as ${username}_private_key. Use this key to access your EC2 instance.
+
+SECURITY IMPORTANT:
+- Keep this private key secure and never share it
+- Store it in ~/.ssh/ directory
+- Set proper permissions: chmod 600 your_key_file
+- Never commit private keys to version control
+- This key is unique to your user account
+
+USAGE INSTRUCTIONS:
+==================
+
+Step 1: Save the Private Key
+- Save the attached file ${username}_private_key
+- Move it to: ~/.ssh/${username}_key
+- Example: mkdir -p ~/.ssh && mv ${username}_private_key ~/.ssh/${username}_key
+
+Step 2: Set Proper Permissions
+- Set restrictive permissions: chmod 600 ~/.ssh/${username}_key
+- Verify permissions: ls -la ~/.ssh/${username}_key
+
+Step 3: Connect to EC2 Instance
+- Use this command: ssh -i ~/.ssh/${username}_key $username@$ip_address
+- Example: ssh -i ~/.ssh/${username}_key $username@$ip_address
+
+Step 4: Verify Connection
+- You should see a welcome message
+- Run 'whoami' to confirm your username
+- Run 'pwd' to see your home directory
+
+Troubleshooting:
+- If connection fails, check your private key file
+- Ensure permissions are correct (chmod 600)
+- Verify the instance IP address is correct
+- Check if you're connecting from an allowed network
+
+Connection Summary:
+- Username: $username
+- Instance: $instance_id ($ip_address)
+- IP Address: $ip_address
+- SSH Command: ssh -i ~/.ssh/${username}_key $username@$ip_address
+
+This is an automated message from the AWS EC2 User Provisioning System.
+If you have any questions or need assistance, please contact your system administrator.
+""")
+
+class WorkItem(NamedTuple):
+    """Everything needed to deliver one user's key, resolved before sending."""
+    username: str
+    user_info: dict
+    recipient_email: str
+    subject: str
+    private_key: bytes
+
+def _is_ascii(text):
+    """Return True if text is pure ASCII (str.isascii() needs Python 3.7)."""
+    return all(ord(c) < 128 for c in text)
+
+class DeliveryUnconfirmed(smtplib.SMTPException):
+    """The SMTP session dropped after a message body was sent, so it may have been delivered."""
+
+class SSHKeyEmailer:
+    def __init__(self, smtp_host, smtp_user=None, smtp_pass=None, smtp_port=25, smtp_workers=8,
+                 max_messages_per_conn=500, html_only=False, smtp_idle_sec=20):
+        """
+        Initialize the SSH key emailer with SMTP settings.
+        
+        Args:
+            smtp_host (str): SMTP server hostname
+            smtp_user (str): SMTP username (optional for port 25)
+            smtp_pass (str): SMTP password (optional for port 25)
+            smtp_port (int): SMTP server port (default: 25)
+            smtp_workers (int): Number of parallel SMTP sessions (default: 8)
+            max_messages_per_conn (int): Messages sent before an SMTP session is recycled (default: 500)
+            html_only (bool): Send only the HTML body, without a plain text alternative
+            smtp_idle_sec (float): Idle time after which a session is checked with NOOP before reuse (default: 20)
+        """
+        self.smtp_host = smtp_host
+        self.smtp_user = smtp_user
+        self.smtp_pass = smtp_pass
+        self.smtp_port = smtp_port
+        self.smtp_workers = max(1, smtp_workers)
+        self.max_messages_per_conn = max(1, max_messages_per_conn)
+        self.html_only = html_only
+        self.smtp_idle_sec = smtp_idle_sec
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._keys_cache = {}
+        
+        # One TLS context shared by every session. It keeps smtplib's default
+        # STARTTLS behaviour of not verifying the relay's certificate.
+        self._ssl_context = ssl.create_default_context()
+        self._ssl_context.check_hostname = False
+        self._ssl_context.verify_mode = ssl.CERT_NONE
+    
+    def __enter__(self):
+        """Allow the emailer to be used as a context manager that owns the SMTP sessions."""
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+    
+    def _connect(self):
+        """
+        Open a new SMTP connection, starting TLS and authenticating once.
+        
+        Returns:
+            smtplib.SMTP: Connected (and authenticated, if configured) SMTP session
+        """
+        server = smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=30)
+        
+        # Start TLS if supported
+        try:
+            server.starttls(context=self._ssl_context)
+            log.debug("✅ TLS connection established")
+        except Exception:
+            log.debug("ℹ️  TLS not supported, continuing without encryption")
+        
+        # Authenticate if credentials provided
+        if self.smtp_user and self.smtp_pass:
+            server.login(self.smtp_user, self.smtp_pass)
+            log.debug("✅ SMTP authentication successful")
+        
+        return server
+    
+    def _get_connection(self):
+        """
+        Return the calling thread's SMTP connection.
+        
+        A new session is opened if the server dropped the old one or if it has
+        already carried max_messages_per_conn messages, since many providers cap
+        messages per connection. Only sessions idle for longer than smtp_idle_sec
+        are checked with NOOP; a drop during a send is retried by send_email.
+        
+        Returns:
+            smtplib.SMTP: Live SMTP session
+        """
+        server = getattr(self._local, 'smtp', None)
+        if server is not None and server.sock is None:
+            # Closed by close() on another thread or after a fatal reply
+            self._discard_connection(server)
+        elif server is not None:
+            if self._local.sent >= self.max_messages_per_conn:
+                log.debug("🔄 SMTP connection message limit reached, reconnecting")
+                self._discard_connection(server)
+            elif time.monotonic() - self._local.last_used <= self.smtp_idle_sec:
+                return server
+            else:
+                try:
+                    server.noop()
+                    return server
+                except (smtplib.SMTPServerDisconnected, OSError):
+                    log.info("ℹ️  SMTP connection lost, reconnecting")
+                    self._discard_connection(server)
+        
+        server = self._connect()
+        self._local.smtp = server
+        self._local.sent = 0
+        self._local.last_used = time.monotonic()
+        with self._connections_lock:
+            self._connections.append(server)
+        return server
+    
+    def _discard_connection(self, server):
+        """Forget an SMTP connection and close it if it is still open."""
+        if getattr(self._local, 'smtp', None) is server:
+            self._local.smtp = None
+        
+        with self._connections_lock:
+            if server in self._connections:
+                self._connections.remove(server)
+        
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+    
+    def close(self):
+        """Close every SMTP connection opened by this emailer."""
+        self._local.smtp = None
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        
+        for server in connections:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+        
+    def load_users(self, users_file, users_stat=None):
+        """
+        Load user information from YAML file.
+        
+        Parsed users are cached in-process (keyed by path, mtime and size) and in
+        a JSON sidecar next to the YAML file, so an unchanged file is never
+        parsed twice.
+        
+        Args:
+            users_file (str): Path to users.yaml file
+            users_stat (os.stat_result): Stat of users_file if already taken (optional)
+            
+        Returns:
+            dict: Dictionary of users with username as key
+        """
+        try:
+            st = users_stat if users_stat is not None else os.stat(users_file)
+            cache_key = os.path.abspath(users_file)
+            
+            # Same file already loaded by this process
+            hit = _USERS_CACHE.get(cache_key)
+            if hit is not None and hit[0] == st.st_mtime_ns and hit[1] == st.st_size:
+                _USERS_CACHE.move_to_end(cache_key)
+                return copy.deepcopy(hit[2])
+            
+            users = self._load_users_uncached(users_file, st)
+            
+            _USERS_CACHE[cache_key] = (st.st_mtime_ns, st.st_size, copy.deepcopy(users))
+            if len(_USERS_CACHE) > USERS_CACHE_SIZE:
+                _USERS_CACHE.popitem(last=False)
+            
+            return users
+        except Exception as e:
+            log.error(f"❌ Error loading users from {users_file}: {e}")
+            return {}
+    
+    def _load_users_uncached(self, users_file, st):
+        """
+        Load users from the JSON sidecar if it is current, otherwise parse the YAML.
+        
+        Args:
+            users_file (str): Path to users.yaml file
+            st (os.stat_result): Stat of users_file
+            
+        Returns:
+            dict: Dictionary of users with username as key
+        """
+        cache_file = users_file + USERS_CACHE_SUFFIX
+        
+        # Reuse the cached parse if it has the current format and the YAML
+        # hasn't changed since
+        try:
+            with open(cache_file, 'r') as f:
+                cached = json.load(f)
+            if (cached.get('_version') == USERS_CACHE_VERSION
+                    and cached.get('_mtime_ns') == st.st_mtime_ns and cached.get('_size') == st.st_size):
+                return cached['users']
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+        
+        with open(users_file, 'rb') as f:
+            records = self._parse_users(f)
+        
+        # Index by username as a string, the way key file names spell it, even
+        # when YAML reads it as a number (username: 1234)
+        users = {}
+        for record in records:
+            record['username'] = str(record['username'])
+            users[record['username']] = record
+        
+        # Best effort: a read-only checkout, or a value JSON can't hold, just
+        # skips the cache. Write to a temp file and swap it in so a failed
+        # write never leaves a truncated sidecar behind.
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_file)),
+                                            prefix=os.path.basename(cache_file) + '.', suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'_version': USERS_CACHE_VERSION, '_mtime_ns': st.st_mtime_ns,
+                           '_size': st.st_size, 'users': users}, f)
+            os.replace(tmp_path, cache_file)
+            tmp_path = None
+        except (OSError, TypeError, ValueError):
+            pass
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+        
+        return users
+    
+    def _parse_users(self, stream):
+        """
+        Parse the 'users' list from a YAML stream, keeping only USER_FIELDS.
+        
+        The document is composed into a node graph and only the values of the
+        wanted fields are constructed, so unused per-user fields never become
+        Python objects. Tags, aliases and merge keys resolve as with
+        yaml.safe_load, since the same loader constructs each value.
+        
+        Args:
+            stream: Binary file object positioned at the start of users.yaml
+            
+        Returns:
+            list: One dict per user entry holding the wanted fields
+        """
+        loader = YamlLoader(stream)
+        try:
+            root = loader.get_single_node()
+            if not isinstance(root, yaml.MappingNode):
+                raise ValueError("users file has no top-level mapping")
+            
+            users_node = None
+            loader.flatten_mapping(root)
+            for key_node, value_node in root.value:
+                if isinstance(key_node, yaml.ScalarNode) and loader.construct_object(key_node) == 'users':
+                    users_node = value_node
+            if not isinstance(users_node, yaml.SequenceNode):
+                raise KeyError('users')
+            
+            records = []
+            for user_node in users_node.value:
+                if not isinstance(user_node, yaml.MappingNode):
+                    raise ValueError(f"users entry is not a mapping (line {user_node.start_mark.line + 1})")
+                
+                # Merge keys are expanded in place; later duplicates win, as in safe_load
+                loader.flatten_mapping(user_node)
+                record = {}
+                for key_node, value_node in user_node.value:
+                    if not isinstance(key_node, yaml.ScalarNode):
+                        continue
+                    field = loader.construct_object(key_node)
+                    if field in USER_FIELDS:
+                        record[field] = loader.construct_object(value_node, deep=True)
+                records.append(record)
+            return records
+        finally:
+            loader.dispose()
+    
+    def _read_key_file(self, username, key_path):
+        """
+        Read a single private key file.
+        
+        Args:
+            username (str): Username the key belongs to
+            key_path (str): Path to the private key file
+            
+        Returns:
+            tuple: (username, key_content, error) where error is None on success
+        """
+        try:
+            with open(key_path, 'rb') as f:
+                return username, f.read(), None
+        except Exception as e:
+            return username, None, e
+    
+    def _scan_key_files(self, keys_dir):
+        """
+        Find private key files in a directory without reading them.
+        
+        Args:
+            keys_dir (str): Path to directory containing private keys
+            
+        Returns:
+            dict: Username -> os.DirEntry for each key file; callers stat only what they use
+        """
+        try:
+            with os.scandir(keys_dir) as entries:
+                return {
+                    entry.name[:-KEY_FILE_SUFFIX_LEN]: entry
+                    for entry in entries
+                    if entry.name.endswith(KEY_FILE_SUFFIX) and entry.is_file()
+                }
+        except FileNotFoundError:
+            log.error(f"❌ Keys directory does not exist: {keys_dir}")
+            return {}
+        except Exception as e:
+            log.error(f"Error loading keys: {e}")
+            sys.exit(1)
+    
+    def load_keys_from_directory(self, keys_dir, usernames=None):
+        """
+        Load SSH private keys from a directory.
+        
+        Key files are read concurrently since each read is a small, latency-bound
+        I/O call. Contents are cached per file by mtime and size, so repeated
+        loads only re-read files that were added or modified.
+        
+        Args:
+            keys_dir (str): Path to directory containing private keys
+            usernames (iterable): Only read keys for these users (optional)
+            
+        Returns:
+            dict: Dictionary of keys with username as key
+        """
+        keys = {}
+        key_files = self._scan_key_files(keys_dir)
+        if usernames is not None:
+            key_files = {username: key_files[username] for username in key_files.keys() & usernames}
+        
+        # Reuse cached contents for files that haven't changed
+        to_read = []
+        for username, entry in key_files.items():
+            key_path = entry.path
+            try:
+                st = entry.stat()
+            except OSError as e:
+                log.warning(f"⚠️  Error loading key for {username}: {e}")
+                continue
+            cached = self._keys_cache.get(key_path)
+            if cached is not None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+                keys[username] = cached[2]
+            else:
+                to_read.append((username, key_path, st))
+        
+        if keys:
+            log.debug(f"♻️  Reusing {len(keys)} cached keys from {keys_dir}")
+        
+        if not to_read:
+            return keys
+        
+        with ThreadPoolExecutor(max_workers=min(16, len(to_read))) as executor:
+            results = executor.map(lambda item: self._read_key_file(item[0], item[1]), to_read)
+            
+            for (_, key_path, st), (username, key_content, error) in zip(to_read, results):
+                if error is None:
+                    keys[username] = key_content
+                    self._keys_cache[key_path] = (st.st_mtime_ns, st.st_size, key_content)
+                    log.debug(f"✅ Loaded key for {username}")
+                else:
+                    log.warning(f"⚠️  Error loading key for {username}: {error}")
+        
+        return keys
+    
+    def create_email_content(self, username, user_info, private_key, instance_info=None, test_email=None,
+                             generated_at=None, include_text=True):
+        """
+        Create email content for SSH key delivery.
+        
+        Args:
+            username (str): Username
+            user_info (dict): User information from YAML
+            private_key (bytes): Unused; the key is sent as an attachment
+            instance_info (dict): Instance information (optional)
+            test_email (str): Unused; kept for backwards compatibility
+            generated_at (str): Generation timestamp shared by the batch (optional)
+            include_text (bool): Render the plain text body as well (default: True)
+            
+        Returns:
+            tuple: (html_content, text_content), text_content is None if not rendered
+        """
+        # Use instance info if provided, otherwise use defaults
+        if not instance_info:
+            instance_info = DEFAULT_INSTANCE_INFO
+        
+        if not generated_at:
+            generated_at = datetime.now(timezone.utc).strftime(TIMESTAMP_FORMAT)
+        
+        # Fill in the per-user fields of the precompiled templates
+        fields = {
+            'username': username,
+            'full_name': user_info['full_name'],
+            'generated': generated_at,
+            'instance_id': instance_info['instance_id'],
+            'ip_address': instance_info['ip_address'],
+            'instance_type': instance_info['instance_type'],
+            'region': instance_info['region'],
+        }
+        html_content = HTML_TEMPLATE.substitute(fields)
+        text_content = TEXT_TEMPLATE.substitute(fields) if include_text else None
+        
+        return html_content, text_content
+    
+    def _build_message(self, to_email, subject, html_content, text_content, private_key, username):
+        """
+        Build the email message carrying an SSH key.
+        
+        Args:
+            to_email (str): Recipient email address
+            subject (str): Email subject
+            html_content (str): HTML email content
+            text_content (str): Plain text email content, or None for an HTML-only message
+            private_key (bytes): Private key content
+            username (str): Username for filename
+            
+        Returns:
+            EmailMessage: Message ready to be serialized and sent
+        """
+        msg = EmailMessage()
+        msg['Subject'] = subject
+        msg['From'] = FROM_HEADER
+        msg['To'] = to_email
+        
+        # Add text body with an HTML alternative, or the HTML body alone
+        if text_content is None:
+            msg.set_content(html_content, subtype='html')
+        else:
+            msg.set_content(text_content)
+            msg.add_alternative(html_content, subtype='html')
+        
+        # Attach private key as file
+        if isinstance(private_key, str):
+            private_key = private_key.encode('utf-8')
+        msg.add_attachment(private_key, maintype='application', subtype='octet-stream',
+                           filename=f'{username}_private_key')
+        
+        return msg
+    
+    def _pipelined_send(self, server, to_email, payload):
+        """
+        Send one message, pipelining MAIL, RCPT and DATA when the server allows it.
+        
+        With PIPELINING (RFC 2920) the three commands go out together and their
+        replies are read afterwards, saving two round trips per message. Servers
+        without it, or non-ASCII addresses, get the same commands one at a time;
+        a non-ASCII address is sent with SMTPUTF8 if the server supports it.
+        
+        Args:
+            server (smtplib.SMTP): Live SMTP session
+            to_email (str): Recipient email address
+            payload (bytes): Serialized message with CRLF line endings
+            
+        Raises:
+            smtplib.SMTPException: The same errors sendmail() raises for a single recipient
+            DeliveryUnconfirmed: The session dropped after the message body was sent
+        """
+        international = not _is_ascii(to_email)
+        server.ehlo_or_helo_if_needed()
+        if international and not server.has_extn('smtputf8'):
+            raise smtplib.SMTPNotSupportedError('SMTPUTF8 not supported by server')
+        
+        try:
+            if server.has_extn('pipelining') and not international:
+                server.putcmd('mail', f'FROM:{smtplib.quoteaddr(FROM_ADDRESS)}')
+                server.putcmd('rcpt', f'TO:{smtplib.quoteaddr(to_email)}')
+                server.putcmd('data')
+                mail_code, mail_resp = server.getreply()
+                rcpt_code, rcpt_resp = server.getreply()
+                data_code, data_resp = server.getreply()
+                
+                if data_code == 354 and (mail_code != 250 or rcpt_code not in (250, 251)):
+                    # The server shouldn't accept DATA without a valid sender and
+                    # recipient; drop the session rather than send an orphaned body,
+                    # and report the rejection that actually happened
+                    server.close()
+                    self._discard_connection(server)
+                    if mail_code != 250:
+                        raise smtplib.SMTPSenderRefused(mail_code, mail_resp, FROM_ADDRESS)
+                    raise smtplib.SMTPRecipientsRefused({to_email: (rcpt_code, rcpt_resp)})
+            else:
+                # Same options send_message() uses for an internationalized address
+                mail_options = ('SMTPUTF8', 'BODY=8BITMIME') if international else ()
+                mail_code, mail_resp = server.mail(FROM_ADDRESS, mail_options)
+                if mail_code == 250:
+                    rcpt_code, rcpt_resp = server.rcpt(to_email)
+                    if rcpt_code in (250, 251):
+                        data_code, data_resp = server.docmd('data')
+        except smtplib.SMTPException:
+            raise
+        except Exception:
+            # Don't leave the session inside a half-open MAIL transaction
+            self._reset_after_error(server, None)
+            raise
+        
+        if mail_code != 250:
+            self._reset_after_error(server, mail_code)
+            raise smtplib.SMTPSenderRefused(mail_code, mail_resp, FROM_ADDRESS)
+        if rcpt_code not in (250, 251):
+            self._reset_after_error(server, rcpt_code)
+            raise smtplib.SMTPRecipientsRefused({to_email: (rcpt_code, rcpt_resp)})
+        if data_code != 354:
+            self._reset_after_error(server, data_code)
+            raise smtplib.SMTPDataError(data_code, data_resp)
+        
+        # Dot-stuff and terminate the body the way SMTP.data() does
+        body = DOT_STUFF_RE.sub(b'..', payload)
+        if not body.endswith(b'\r\n'):
+            body += b'\r\n'
+        
+        # Once the end-of-data marker may have gone out the server may already
+        # have queued the message, so a lost session here must not be retried
+        try:
+            server.send(body + b'.\r\n')
+            code, resp = server.getreply()
+        except smtplib.SMTPServerDisconnected as e:
+            raise DeliveryUnconfirmed(f"connection lost after the message was sent, not resending: {e}") from e
+        if code != 250:
+            self._reset_after_error(server, code)
+            raise smtplib.SMTPDataError(code, resp)
+    
+    def _reset_after_error(self, server, code):
+        """Drop the session on a 421 reply, otherwise RSET it for the next message."""
+        if code == 421:
+            server.close()
+            self._discard_connection(server)
+            return
+        try:
+            server.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+    
+    def _send_message(self, to_email, msg):
+        """
+        Send a built message over this thread's persistent SMTP connection.
+        
+        If the server drops the connection before the message body has been
+        sent, it is reopened and the message is retried once. A drop after
+        that is not retried, since the message may already be queued.
+        
+        Args:
+            to_email (str): Recipient email address
+            msg (EmailMessage): Message to send
+            
+        Raises:
+            Exception: Whatever smtplib raised if the message could not be sent
+        """
+        # Serialize once with CRLF line endings and pass the envelope explicitly,
+        # so smtplib doesn't re-parse the address headers. Non-ASCII addresses
+        # need UTF-8 headers, as send_message() would use.
+        policy = email.policy.SMTP if _is_ascii(to_email) else email.policy.SMTPUTF8
+        payload = msg.as_bytes(policy=policy)
+        
+        server = self._get_connection()
+        try:
+            self._pipelined_send(server, to_email, payload)
+        except DeliveryUnconfirmed:
+            self._discard_connection(server)
+            raise
+        except smtplib.SMTPServerDisconnected:
+            log.info("ℹ️  SMTP connection lost while sending, reconnecting")
+            self._discard_connection(server)
+            server = self._get_connection()
+            self._pipelined_send(server, to_email, payload)
+        self._local.sent += 1
+        self._local.last_used = time.monotonic()
+    
+    def send_email(self, to_email, subject, html_content, text_content, private_key, username):
+        """
+        Send email with SSH key.
+        
+        Args:
+            to_email (str): Recipient email address
+            subject (str): Email subject
+            html_content (str): HTML email content
+            text_content (str): Plain text email content
+            private_key (bytes): Private key content
+            username (str): Username for filename
+            
+        Returns:
+            bool: True if email sent successfully, False otherwise
+        """
+        try:
+            msg = self._build_message(to_email, subject, html_content, text_content, private_key, username)
+            self._send_message(to_email, msg)
+            log.debug(f"✅ Email sent successfully to {to_email}")
+            return True
+                
+        except Exception as e:
+            log.error(f"❌ Failed to send email to {to_email}: {e}")
+            return False
+    
+    def _send_test_bundle(self, batch, test_email):
+        """
+        Send every key in the batch to the test address as one message.
+        
+        Args:
+            batch (list): List of WorkItem entries
+            test_email (str): Test email address
+            
+        Returns:
+            int: Number of keys delivered (all or none)
+        """
+        msg = EmailMessage()
+        msg['Subject'] = f'SSH Keys for EC2 Access - test bundle of {len(batch)} users'
+        msg['From'] = FROM_HEADER
+        msg['To'] = test_email
+        
+        lines = [f"Test bundle of {len(batch)} SSH keys, one attachment per user:", ""]
+        lines.extend(f"- {item.username} ({item.user_info.get('email', 'no email')})" for item in batch)
+        msg.set_content("\n".join(lines) + "\n")
+        
+        for item in batch:
+            private_key = item.private_key
+            if isinstance(private_key, str):
+                private_key = private_key.encode('utf-8')
+            msg.add_attachment(private_key, maintype='application', subtype='octet-stream',
+                               filename=f'{item.username}_private_key')
+        
+        with self:
+            try:
+                self._send_message(test_email, msg)
+            except Exception as e:
+                log.error(f"❌ Failed to send test bundle to {test_email}: {e}")
+                return 0
+        
+        log.info(f"✅ Test bundle with {len(batch)} keys sent to {test_email}")
+        return len(batch)
+    
+    def _plan_batch(self, users, keys, test_email=None):
+        """
+        Resolve everything the send needs for each user, once and up front.
+        
+        Only users that have a key can be processed; the rest are reported in
+        a single warning.
+        
+        Args:
+            users (dict): Users with username as key
+            keys (dict): Private keys with username as key
+            test_email (str): Test email address (optional)
+            
+        Returns:
+            list: WorkItem per user with a key, ordered by username
+        """
+        missing = sorted(users.keys() - keys.keys())
+        if missing:
+            log.warning(f"⚠️  No key found for {len(missing)} user(s): {', '.join(missing)}")
+        
+        batch = []
+        for username in sorted(users.keys() & keys.keys()):
+            user_info = users[username]
+            batch.append(WorkItem(
+                username=username,
+                user_info=user_info,
+                recipient_email=test_email if test_email else str(user_info.get('email') or 'user@example.com'),
+                subject=SUBJECT_PREFIX + username,
+                private_key=keys[username],
+            ))
+        
+        return batch
+    
+    def _send_one(self, item, generated_at=None):
+        """
+        Build and send the SSH key email for a single user.
+        
+        Args:
+            item (WorkItem): Prepared delivery for one user
+            generated_at (str): Generation timestamp shared by the batch (optional)
+            
+        Returns:
+            bool: True if email sent successfully, False otherwise
+        """
+        log.debug(f"📧 Processing user: {item.username}")
+        
+        # Create email content
+        html_content, text_content = self.create_email_content(
+            item.username, item.user_info, item.private_key, generated_at=generated_at,
+            include_text=not self.html_only
+        )
+        
+        if self.send_email(item.recipient_email, item.subject, html_content, text_content,
+                           item.private_key, item.username):
+            return True
+        
+        log.error(f"❌ Failed to send email for {item.username}")
+        return False
+    
+    def _send_batch(self, batch, generated_at=None):
+        """
+        Send emails for a batch of users in parallel, one SMTP session per worker thread.
+        
+        Sending stops early once at least ABORT_MIN_ATTEMPTS messages have been
+        attempted and a third or more of them failed, since that usually means
+        bad credentials or an unreachable server. Messages not yet started are
+        skipped; those already being sent are still counted.
+        
+        Args:
+            batch (list): List of WorkItem entries
+            generated_at (str): Generation timestamp shared by the batch (optional)
+            
+        Returns:
+            int: Number of emails sent successfully
+        """
+        success_count = 0
+        failed_count = 0
+        
+        # No point opening more SMTP sessions than there are messages
+        workers = max(1, min(self.smtp_workers, len(batch)))
+        
+        aborted = False
+        with self, ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self._send_one, item, generated_at): item for item in batch}
+            
+            # Keep collecting after an abort so sends already in flight are counted
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                
+                try:
+                    sent = future.result()
+                except Exception as e:
+                    log.error(f"❌ Failed to send email for {futures[future].username}: {e}")
+                    sent = False
+                
+                if sent:
+                    success_count += 1
+                    continue
+                
+                failed_count += 1
+                attempted = success_count + failed_count
+                if not aborted and attempted >= ABORT_MIN_ATTEMPTS and failed_count * 3 >= attempted:
+                    aborted = True
+                    skipped = sum(pending.cancel() for pending in futures)
+                    log.error(f"🛑 {failed_count} of {attempted} emails failed, "
+                              f"skipping {skipped} remaining sends")
+        
+        return success_count
+    
+    def send_keys_to_users(self, users_file, keys_dir, test_email=None, dry_run=False, dry_run_render=False,
+                           users_stat=None, test_bundle=False):
+        """
+        Send SSH keys to all users via email.
+        
+        Args:
+            users_file (str): Path to users.yaml file
+            keys_dir (str): Path to keys directory
+            test_email (str): Test email address (optional)
+            dry_run (bool): If True, don't actually send emails
+            dry_run_render (bool): In dry run mode, also render and show the text and HTML bodies
+            users_stat (os.stat_result): Stat of users_file if already taken (optional)
+            test_bundle (bool): With test_email, send all keys in a single message
+            
+        Returns:
+            bool: True if all emails sent successfully, False otherwise
+        """
+        log.info("=== SSH Key Email Delivery ===")
+        
+        # Load users, then only the keys that will actually be sent
+        users = self.load_users(users_file, users_stat)
+        if dry_run:
+            # A dry run only needs to know which users have a key file
+            keys = dict.fromkeys(self._scan_key_files(keys_dir).keys() & users.keys())
+        else:
+            keys = self.load_keys_from_directory(keys_dir, users.keys())
+        
+        log.info(f"📋 Users loaded: {len(users)}")
+        log.info(f"🔑 Keys loaded: {len(keys)}")
+        log.info("")
+        
+        if dry_run:
+            log.info("🧪 DRY RUN MODE - No emails will be sent")
+            log.info("")
+        
+        # All emails in one run share the same generation timestamp
+        generated_at = datetime.now(timezone.utc).strftime(TIMESTAMP_FORMAT)
+        
+        # Process each user
+        success_count = 0
+        total_count = len(users)
+        
+        batch = self._plan_batch(users, keys, test_email)
+        
+        if dry_run:
+            # Emit the whole dry-run listing as one log record
+            lines = []
+            for item in batch:
+                if not test_email and not item.user_info.get('email'):
+                    log.warning(f"⚠️  No email address for {item.username}, would use {item.recipient_email}")
+                lines.append(f"🧪 Would send email to: {item.recipient_email}")
+                lines.append(f"   Subject: {item.subject}")
+                if dry_run_render:
+                    html_content, text_content = self.create_email_content(
+                        item.username, item.user_info, item.private_key, generated_at=DRY_RUN_TIMESTAMP,
+                        include_text=not self.html_only
+                    )
+                    if text_content is not None:
+                        lines.append("   --- Text body ---")
+                        lines.append(text_content)
+                    lines.append("   --- HTML body ---")
+                    lines.append(html_content)
+                success_count += 1
+            if lines:
+                log.info("\n".join(lines))
+        elif test_email and test_bundle:
+            success_count = self._send_test_bundle(batch, test_email) if batch else 0
+        else:
+            # Submit the batch ordered by recipient domain (workers still pick up items as they free up)
+            batch.sort(key=lambda item: item.recipient_email.rsplit('@', 1)[-1].lower())
+            success_count = self._send_batch(batch, generated_at)
+        
+        # Summary
+        log.info("")
+        log.info("=== Email Delivery Summary ===")
+        log.info(f"Total users processed: {total_count}")
+        log.info(f"Emails sent successfully: {success_count}")
+        log.info(f"Emails failed: {total_count - success_count}")
+        log.info("")
+        
+        if success_count > 0:
+            log.info(f"✅ SSH keys processed successfully for {success_count} users")
+            if test_email:
+                log.info(f"📧 All emails sent to test address: {test_email}")
+            return True
+        else:
+            log.error("❌ No emails were processed successfully")
+            return False